@@ -9,21 +9,30 @@ from os import path
 import argparse
 import asyncio
 import builtins
+import contextvars
 import copy
+import fnmatch
+import functools
 import glob
+import heapq
 import inspect
 import io
 import json
+import keyword
 import os
+import queue
 import random
 import re
+import shlex
 import shutil
+import signal
 import subprocess
 import sys
+import threading
 import time
 import traceback
 import types
-from collections import abc
+from collections import OrderedDict, abc, deque
 
 # If we were launched directly, a reference to this module is already in sys.modules[__name__].
 # Stash another reference in sys.modules["hancho"] so that build.hancho and descendants don't try
@@ -35,12 +44,134 @@ sys.modules["hancho"] = sys.modules[__name__]
 
 first_line_block = True
 
+# If we can't get SIGWINCH when the terminal is resized, we re-check the terminal width after this
+# many lines.
+TERM_COLS_REFRESH = 100
+watching_resize = False
+
+
+def terminal_columns():
+    """Returns the terminal width. os.get_terminal_size() is a syscall and we need the width for
+    every status line, so it's cached until the terminal is resized."""
+    app.term_cols_age += 1
+    if app.term_cols is None or (not watching_resize and app.term_cols_age >= TERM_COLS_REFRESH):
+        app.term_cols = os.get_terminal_size().columns
+        app.term_cols_age = 0
+    return app.term_cols
+
+
+def watch_resize():
+    """Installs a SIGWINCH handler that invalidates the cached terminal width."""
+    global watching_resize  # pylint: disable=global-statement
+    if hasattr(signal, "SIGWINCH"):
+        def on_resize(_signum, _frame):
+            app.term_cols = None
+        signal.signal(signal.SIGWINCH, on_resize)
+        watching_resize = True
+
 
 def log_line(message):
-    app.log += message
-    if not app.flags.quiet:
-        sys.stdout.write(message)
-        sys.stdout.flush()
+    app.log_lines.append(message)
+    if app.flags.quiet:
+        return
+    if app.log_error is not None:
+        # The writer thread couldn't write to stdout, so neither can we.
+        raise app.log_error
+    app.log_buffer.append(message)
+
+    # While tasks are running we batch up output and write it once per event loop iteration
+    # instead of doing a write+flush per line.
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+    if loop is None:
+        flush_log()
+    elif not app.log_flush_pending:
+        app.log_flush_pending = True
+        loop.call_soon(flush_log)
+
+
+def flush_log():
+    """Writes out everything log_line() has buffered, or hands it to the log writer thread if
+    there is one."""
+    app.log_flush_pending = False
+    if app.log_buffer:
+        text = "".join(app.log_buffer)
+        app.log_buffer.clear()
+        if app.log_queue is not None:
+            send_to_log_writer(text)
+        else:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+
+
+def start_log_writer():
+    """Starts a thread that does the actual writes to stdout while tasks are running, so the event
+    loop doesn't block on a slow terminal. The queue is bounded so a terminal that can't keep up
+    eventually slows the build down instead of eating all our memory."""
+    app.log_error = None
+    app.log_queue = queue.Queue(maxsize=1024)
+    app.log_writer = threading.Thread(target=log_writer_main, args=(app.log_queue,), daemon=True)
+    app.log_writer.start()
+
+
+def log_writer_main(log_queue):
+    try:
+        while (text := log_queue.get()) is not None:
+            if isinstance(text, threading.Event):
+                # sync_log() is waiting for us to catch up.
+                text.set()
+                continue
+            sys.stdout.write(text)
+            sys.stdout.flush()
+    except OSError as ex:
+        # Probably a broken pipe. We can't raise this from here, so we leave it for the main thread
+        # to pick up.
+        app.log_error = ex
+
+
+def send_to_log_writer(item):
+    """Puts 'item' in the log writer's queue, unless the writer died. A dead writer never empties
+    the queue, so we have to keep checking on it instead of blocking on a full queue."""
+    while app.log_error is None:
+        try:
+            app.log_queue.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+    error = app.log_error
+    app.log_writer.join()
+    app.log_writer = None
+    app.log_queue = None
+    raise error
+
+
+def sync_log():
+    """Makes sure everything we've logged so far has actually been written to stdout, for code that
+    is about to write to stdout without going through log()."""
+    flush_log()
+    if app.log_queue is None:
+        return
+    written = threading.Event()
+    send_to_log_writer(written)
+    while not written.wait(timeout=0.1):
+        if app.log_error is not None:
+            raise app.log_error
+
+
+def stop_log_writer():
+    """Flushes everything pending to the log writer thread and waits for it to finish. Raises
+    whatever error stopped the writer thread, if anything did."""
+    if app.log_writer is None:
+        return
+    flush_log()
+    send_to_log_writer(None)
+    app.log_writer.join()
+    app.log_writer = None
+    app.log_queue = None
+    if app.log_error is not None:
+        raise app.log_error
 
 
 def log(message, *, sameline=False, **kwargs):
@@ -59,7 +190,7 @@ def log(message, *, sameline=False, **kwargs):
         return
 
     if sameline:
-        output = output[: os.get_terminal_size().columns - 1]
+        output = output[: terminal_columns() - 1]
         output = "\r" + output + "\x1B[K"
         log_line(output)
     else:
@@ -82,7 +213,7 @@ def line_block(lines):
             print()
         line = lines[y]
         if line is not None:
-            line = line[: os.get_terminal_size().columns - 20]
+            line = line[: terminal_columns() - 20]
         print(line, end="")
         print("\x1b[K", end="")
         sys.stdout.flush()
@@ -98,12 +229,23 @@ def log_exception():
 # Path manipulation
 
 
+@functools.lru_cache(maxsize=65536)
+def abs_path_cached(raw_path):
+    """abspath() for paths that are already absolute. Those don't depend on cwd, so we can cache
+    them, and interning the results means tasks sharing a directory share one string for it."""
+    return sys.intern(path.abspath(raw_path))
+
+
 def abs_path(raw_path, strict=False) -> str | list[str]:
 
     if listlike(raw_path):
         return [abs_path(p, strict) for p in raw_path]
 
-    result = path.abspath(raw_path)
+    # Relative paths depend on cwd, so we resolve them against it before hitting the cache. That
+    # still saves the normpath(), which is most of the cost of abspath().
+    if not path.isabs(raw_path):
+        raw_path = path.join(os.getcwd(), raw_path)
+    result = abs_path_cached(raw_path)
     if strict and not path.exists(result):
         raise FileNotFoundError(raw_path)
     return result
@@ -123,8 +265,11 @@ def rel_path(path1, path2):
 
 
 def join_path(path1, path2, *args):
+    # Joining two plain strings is the common case, skip straight to the cache for those.
+    if not args and isinstance(path1, str) and isinstance(path2, str) and path2:
+        return join_path_cached(path1, path2)
     result = join_path2(path1, path2, *args)
-    return flatten(result) if listlike(result) else result
+    return flat_view(result) if listlike(result) else result
 
 
 def join_path2(path1, path2, *args):
@@ -132,12 +277,17 @@ def join_path2(path1, path2, *args):
     if len(args) > 0:
         return [join_path(path1, p) for p in join_path(path2, *args)] # pylint: disable=E1120
     if listlike(path1):
-        return [join_path(p, path2) for p in flatten(path1)]
+        return [join_path(p, path2) for p in flat_view(path1)]
     if listlike(path2):
-        return [join_path(path1, p) for p in flatten(path2)]
+        return [join_path(path1, p) for p in flat_view(path2)]
 
     if not path2:
         raise ValueError(f"Cannot join '{path1}' with '{type(path2)}' == '{path2}'")
+    return join_path_cached(path1, path2)
+
+
+@functools.lru_cache(maxsize=65536)
+def join_path_cached(path1, path2):
     return path.join(path1, path2)
 
 
@@ -171,27 +321,43 @@ def dictlike(variant):
 
 
 def flatten(variant):
+    """Returns a new flat list of everything in 'variant'."""
+    result = flat_view(variant)
+    return list(result) if result is variant else result
+
+
+def flat_view(variant):
+    """flatten() for our own callers that only read the result. Nearly every list we flatten is
+    already a flat list of strings, and those get returned as-is instead of copied, so the result
+    must not be modified."""
+    if isinstance(variant, list) and all(isinstance(element, str) for element in variant):
+        return variant
     if listlike(variant):
-        return [x for element in variant for x in flatten(element)]
-    elif variant is None:
+        return [x for element in variant for x in flat_view(element)]
+    if variant is None:
         return []
     return [variant]
 
 
 def join_prefix(prefix, strings):
-    return [prefix + str(s) for s in flatten(strings)]
+    return [prefix + str(s) for s in flat_view(strings)]
 
 
 def join_suffix(strings, suffix):
-    return [str(s) + suffix for s in flatten(strings)]
+    return [str(s) + suffix for s in flat_view(strings)]
 
 
 def stem(filename):
-    filename = flatten(filename)[0]
+    filename = flat_view(filename)[0]
     filename = path.basename(filename)
     return path.splitext(filename)[0]
 
 
+# Log lines only ever use a handful of colors, so we keep their escape strings around instead of
+# formatting a new one for every line.
+color_cache = {}
+
+
 def color(red=None, green=None, blue=None):
     """Converts RGB color to ANSI format string."""
     # Color strings don't work in Windows console, so don't emit them.
@@ -199,7 +365,11 @@ def color(red=None, green=None, blue=None):
     #    return ""
     if red is None:
         return "\x1B[0m"
-    return f"\x1B[38;2;{red};{green};{blue}m"
+    result = color_cache.get((red, green, blue), None)
+    if result is None:
+        result = f"\x1B[38;2;{red};{green};{blue}m"
+        color_cache[(red, green, blue)] = result
+    return result
 
 
 def run_cmd(cmd):
@@ -216,10 +386,151 @@ def swap_ext(name, new_ext):
     return path.splitext(name)[0] + new_ext
 
 
+def dir_entries(dirname):
+    """Returns a dict of name -> os.DirEntry for everything in 'dirname'. The listing is cached, so
+    a directory full of dependencies costs one scandir() instead of one stat() per file."""
+    entries = app.dir_cache.get(dirname, None)
+    if entries is None:
+        with os.scandir(dirname) as it:
+            entries = {entry.name: entry for entry in it}
+        app.dir_cache[dirname] = entries
+    return entries
+
+
+def dir_entry(filename):
+    """Returns the cached os.DirEntry for 'filename', or None if it doesn't exist."""
+    dirname, basename = path.split(abs_path(filename))
+    try:
+        return dir_entries(dirname).get(basename, None)
+    except OSError:
+        return None
+
+
+def file_exists(filename):
+    """path.exists(), but answered from the cached directory listings. Only symlinks need a
+    stat() to see if they're broken. Names that aren't in the listing get a real stat() too, as
+    case-insensitive filesystems (Windows, macOS) can have the file under a differently-cased
+    name."""
+    entry = dir_entry(filename)
+    if entry is None:
+        return path.exists(filename)
+    return not entry.is_symlink() or path.exists(filename)
+
+
+def file_isfile(filename):
+    """path.isfile(), but answered from the cached directory listings when the name is in them."""
+    entry = dir_entry(filename)
+    if entry is None:
+        return path.isfile(filename)
+    return entry.is_file()
+
+
+def forget_dir(dirname):
+    """Drops the cached listing for 'dirname', used once we've written files into it."""
+    app.dir_cache.pop(dirname, None)
+
+
+def forget_file(filename):
+    """Drops the cached mtime for 'filename' and the listing of its directory."""
+    app.mtime_cache.pop(filename, None)
+    forget_dir(path.dirname(filename))
+
+
+def glob_files(pattern, root_dir=None, **kwargs):
+    """glob.glob(), but with a fast path for patterns like "src/*.cpp" where only the filename has
+    wildcards. Those do a fresh scandir() and leave the listing in the cache mtime() uses, so
+    checking the matched files later doesn't need another scandir()."""
+
+    dirname, basename = path.split(pattern)
+    if kwargs or glob.has_magic(dirname) or not glob.has_magic(basename) or "**" in basename:
+        return glob.glob(pattern, root_dir=root_dir, **kwargs)
+
+    # Whatever's globbing may have just created files, so we can't trust an old listing.
+    abs_dir = path.abspath(path.join(root_dir or os.curdir, dirname))
+    forget_dir(abs_dir)
+    try:
+        entries = dir_entries(abs_dir)
+    except OSError:
+        return []
+
+    names = fnmatch.filter(entries, basename)
+    # Like glob(), wildcards don't match hidden files unless the pattern starts with a '.'
+    if not basename.startswith("."):
+        names = [name for name in names if not name.startswith(".")]
+    return [path.join(dirname, name) for name in names]
+
+
+def make_dirs(dirname):
+    """os.makedirs() that remembers which directories already exist so that tasks sharing an
+    output directory don't all hit the filesystem for it."""
+    if dirname in app.dirs_made:
+        return
+    os.makedirs(dirname, exist_ok=True)
+    # All the parent directories exist now too.
+    while dirname not in app.dirs_made:
+        app.dirs_made.add(dirname)
+        parent = path.dirname(dirname)
+        if parent == dirname:
+            break
+        dirname = parent
+
+
 def mtime(filename):
     """Gets the file's mtime and tracks how many times we've called mtime()"""
     app.mtime_calls += 1
-    return os.stat(filename).st_mtime_ns
+    filename = abs_path(filename)
+    result = app.mtime_cache.get(filename, None)
+    if result is None:
+        dirname, basename = path.split(filename)
+        entry = dir_entries(dirname).get(basename, None)
+        if entry is None:
+            # Not in the listing under this exact name, but on case-insensitive filesystems
+            # (Windows, macOS) the file can still exist under a differently-cased name. Let
+            # stat() decide, it raises FileNotFoundError if the file really is missing.
+            result = os.stat(filename).st_mtime_ns
+        else:
+            # DirEntry caches its own stat() result.
+            result = entry.stat().st_mtime_ns
+        app.mtime_cache[filename] = result
+    return result
+
+
+def find_newer(files, min_mtime):
+    """Returns the first file in 'files' with an mtime >= 'min_mtime', or None. Files we already
+    know the mtime of are checked first, so if one of those changed we don't have to stat() the
+    rest."""
+    for file in files:
+        known = app.mtime_cache.get(file, None)
+        if known is not None and known >= min_mtime:
+            return file
+    for file in files:
+        if mtime(file) >= min_mtime:
+            return file
+    return None
+
+
+def read_depfile(filename, depformat):
+    """Reads the list of dependencies out of a C dependencies file. The parsed list is cached
+    until the depfile's mtime changes."""
+
+    file_mtime = mtime(filename)
+    cached = app.depfile_cache.get((filename, depformat), None)
+    if cached is not None and cached[0] == file_mtime:
+        return cached[1]
+
+    with open(filename, encoding="utf-8") as depfile:
+        if depformat == "msvc":
+            # MSVC /sourceDependencies
+            deplines = json.loads(depfile.read())["Data"]["Includes"]
+        elif depformat == "gcc":
+            # GCC -MMD
+            deplines = depfile.read().split()
+            deplines = [d for d in deplines[1:] if d != "\\"]
+        else:
+            raise ValueError(f"Invalid dependency file format {depformat}")
+
+    app.depfile_cache[(filename, depformat)] = (file_mtime, deplines)
+    return deplines
 
 
 def maybe_as_number(text):
@@ -238,6 +549,10 @@ def maybe_as_number(text):
 # Heplers for managing variants (could be Config, list, dict, etc.)
 
 
+# Immutable types that can't contain anything else, so they never need copying or awaiting.
+plain_types = (str, int, float, bool, type(None))
+
+
 def merge_variant(lhs, rhs):
     if isinstance(lhs, Config) and dictlike(rhs):
         for key, rval in rhs.items():
@@ -245,6 +560,10 @@ def merge_variant(lhs, rhs):
             if lval is None or rval is not None:
                 lhs[key] = merge_variant(lval, rval)
         return lhs
+    # Every task merges in all the fields of its parent configs, and nearly all of them are plain
+    # strings. Those can be shared as-is instead of going through deepcopy().
+    if type(rhs) in plain_types:
+        return rhs
     return copy.deepcopy(rhs)
 
 
@@ -269,24 +588,62 @@ def map_variant(key, val, apply):
     return val
 
 
-async def await_variant(variant):
-    """Recursively replaces every awaitable in the variant with its awaited value."""
+def has_awaitables(variant):
+    """Checks if there's anything in the variant that await_variant() would need to await. This
+    doesn't await anything itself, so it's much cheaper than awaiting every node."""
 
-    if isinstance(variant, Promise):
-        variant = await variant.get()
-        variant = await await_variant(variant)
-    elif isinstance(variant, Task):
-        await variant.await_done()
-        variant = await await_variant(variant.out_files)
-    elif dictlike(variant):
-        for key, val in variant.items():
-            variant[key] = await await_variant(val)
-    elif listlike(variant):
-        for key, val in enumerate(variant):
-            variant[key] = await await_variant(val)
-    else:
-        while inspect.isawaitable(variant):
+    pending = [variant]
+    while pending:
+        variant = pending.pop()
+        if type(variant) in plain_types:
+            continue
+        if isinstance(variant, (Promise, Task)) or inspect.isawaitable(variant):
+            return True
+        if dictlike(variant):
+            pending.extend(variant.values())
+        elif listlike(variant):
+            pending.extend(variant)
+    return False
+
+
+async def await_value(variant):
+    """Awaits a single value until it's no longer a Promise, Task, or other awaitable."""
+    while True:
+        if isinstance(variant, Promise):
+            variant = await variant.get()
+        elif isinstance(variant, Task):
+            await variant.await_done()
+            variant = variant.out_files
+        elif inspect.isawaitable(variant):
             variant = await variant
+        else:
+            return variant
+
+
+async def await_variant(variant):
+    """Replaces every awaitable in the variant with its awaited value."""
+
+    # Most task configs don't contain anything awaitable, so check that first.
+    if not has_awaitables(variant):
+        return variant
+
+    variant = await await_value(variant)
+    pending = deque([variant])
+    while pending:
+        container = pending.popleft()
+        if dictlike(container):
+            items = list(container.items())
+        elif listlike(container):
+            items = list(enumerate(container))
+        else:
+            continue
+        for key, val in items:
+            if type(val) in plain_types:
+                continue
+            new_val = await await_value(val)
+            if new_val is not val:
+                container[key] = new_val
+            pending.append(new_val)
 
     return variant
 
@@ -358,11 +715,14 @@ class Dumper:
 
 
 class Utils:
+    # No per-instance __dict__, Config stores everything in itself.
+    __slots__ = ()
+
     # fmt: off
     abs_path    = staticmethod(abs_path)
     color       = staticmethod(color)
     flatten     = staticmethod(flatten)
-    glob        = staticmethod(glob.glob)
+    glob        = staticmethod(glob_files)
     hancho_dir  = path.dirname(path.realpath(__file__))
     join_path   = staticmethod(join_path)
     join_prefix = staticmethod(join_prefix)
@@ -388,6 +748,8 @@ class Config(dict, Utils):
     arbitrary "merging" of dicts/keys and text template expansion.
     """
 
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         self.merge(*args)
         self.merge(kwargs)
@@ -412,7 +774,7 @@ class Config(dict, Utils):
     # ----------------------------------------
 
     def merge(self, *args, **kwargs):
-        for arg in flatten(args):
+        for arg in flat_view(args):
             if arg is not None:
                 assert dictlike(arg)
                 merge_variant(self, arg)
@@ -454,6 +816,26 @@ MAX_EXPAND_DEPTH = 20
 # Matches macros inside a string.
 macro_regex = re.compile("{[^{}]*}")
 
+# Splits a template into (is_macro, text) tokens in a single pass through the regex engine. Braces
+# that aren't part of a macro come out as literal text.
+template_scanner = re.Scanner([
+    (macro_regex.pattern, lambda _, token: (True, token)),
+    ("[^{]+",             lambda _, token: (False, token)),
+    ("{",                 lambda _, token: (False, token)),
+])
+
+# Templates are almost always static strings shared by many tasks, so we only want to scan each one
+# for macros once. Maps template text to a function generated by compile_template(), or to None if
+# the template contains no macros. Least recently used entries are dropped once it's full.
+template_cache = OrderedDict()
+TEMPLATE_CACHE_SIZE = 4096
+
+# Maps macro text (including the braces) to a function generated by compile_macro().
+macro_cache = {}
+
+# Matches macros that are a single function call, like "{rel_path(task_dir, repo_dir)}".
+call_regex = re.compile(r"\s*([A-Za-z_]\w*)\s*\(([\w\s,]*)\)\s*")
+
 # ----------------------------------------
 # Helper methods
 
@@ -535,10 +917,120 @@ class Expander:
         return val
 
 
-def expand_text(expander, text):
-    """Replaces all macros in 'text' with their expanded, stringified values."""
+def parse_template(text):
+    """Splits 'text' into (literal, macro) segments. The macro in the final segment may be None.
+    Returns an empty list if 'text' contains no macros."""
+
+    tokens, remainder = template_scanner.scan(text)
+    assert not remainder
+
+    segments = []
+    literal = ""
+    for is_macro, token in tokens:
+        if is_macro:
+            segments.append((literal, token))
+            literal = ""
+        else:
+            literal += token
+    if segments and literal:
+        segments.append((literal, None))
+    return segments
+
+
+def compile_template(text):
+    """Generates a Python function that takes an Expander and returns 'text' with all its macros
+    expanded, so that expanding a template is straight-line code instead of a scan over the string.
+    Returns None if 'text' contains no macros."""
+
+    template = None
+    if macro_regex.fullmatch(text):
+        # The whole template is a single macro, which is common enough ("{in_src}", "{command}")
+        # that it's worth skipping the scan and code generation.
+        name = text[1:-1].strip()
+        if is_name(name):
+            def name_template(expander):
+                return stringify_variant(expand_name(expander, name, text))
+            template = name_template
+        else:
+            def macro_template(expander):
+                return stringify_variant(expand_macro(expander, text))
+            template = macro_template
+    elif segments := parse_template(text):
+        terms = []
+        for literal, macro in segments:
+            if literal:
+                terms.append(repr(literal))
+            if macro is None:
+                continue
+            if is_name(name := macro[1:-1].strip()):
+                terms.append(f"stringify_variant(expand_name(expander, {name!r}, {macro!r}))")
+            else:
+                terms.append(f"stringify_variant(expand_macro(expander, {macro!r}))")
+        # A chain of '+' compiles to a nested expression, which blows the compiler's recursion
+        # limit on templates with a thousand or so macros. A tuple is flat no matter how long.
+        source = f"def template(expander):\n    return ''.join(({', '.join(terms)},))\n"
+        scope = {
+            "expand_macro": expand_macro,
+            "expand_name": expand_name,
+            "stringify_variant": stringify_variant,
+        }
+        exec(compile(source, "<template>", "exec", dont_inherit=True), scope)  # pylint: disable=exec-used
+        template = scope["template"]
+
+    return template
+
 
-    if not macro_regex.search(text):
+def scan_template(text):
+    """Like compile_template(), but walks the segments of 'text' directly instead of generating
+    code. Cheaper for text we only expect to expand once."""
+
+    segments = parse_template(text)
+    if not segments:
+        return None
+
+    def template(expander):
+        result = []
+        for literal, macro in segments:
+            result.append(literal)
+            if macro is None:
+                continue
+            if is_name(name := macro[1:-1].strip()):
+                result.append(stringify_variant(expand_name(expander, name, macro)))
+            else:
+                result.append(stringify_variant(expand_macro(expander, macro)))
+        return "".join(result)
+    return template
+
+
+def cache_template(text, template):
+    """Adds a template to template_cache, dropping the least recently used one if it's full."""
+    template_cache[text] = template
+    if len(template_cache) > TEMPLATE_CACHE_SIZE:
+        template_cache.popitem(last=False)
+
+
+def expand_text(expander, text, rescan=False):
+    """Replaces all macros in 'text' with their expanded, stringified values. 'rescan' is set when
+    'text' is itself the result of an expansion."""
+
+    # Most text we see has no macros at all, including every fully expanded command line.
+    if "{" not in text:
+        return text
+
+    # Text we produced ourselves is usually unique to one task, and whatever braces are left in it
+    # are most likely shell syntax like "${HOME}". Not worth generating code for or caching. Other
+    # text gets scanned the first time we see it, and compiled once we know it's a real template.
+    cacheable = False
+    if not rescan and text in template_cache:
+        template = template_cache[text]
+        template_cache.move_to_end(text)
+    else:
+        template = scan_template(text)
+        cacheable = not rescan
+
+    if template is None:
+        if cacheable:
+            cache_template(text, None)
         return text
 
     if expander.trace:
@@ -547,15 +1039,12 @@ def expand_text(expander, text):
 
     # ==========
 
-    temp = text
-    result = ""
-    while span := macro_regex.search(temp):
-        result += temp[0 : span.start()]
-        macro = temp[span.start() : span.end()]
-        variant = expand_macro(expander, macro)
-        result += stringify_variant(variant)
-        temp = temp[span.end() :]
-    result += temp
+    # Nested expansions save and restore this, so it only counts failures in our own macros.
+    outer_failures = app.macro_failures
+    app.macro_failures = 0
+    result = template(expander)
+    failures = app.macro_failures
+    app.macro_failures = outer_failures
 
     # ==========
 
@@ -563,13 +1052,59 @@ def expand_text(expander, text):
     if expander.trace:
         log(trace_prefix(expander) + f"┗ expand_text '{text}' = '{result}'")
 
+    # Text whose macros don't expand is usually not a template at all (shell code, JSON, etc), and
+    # we don't want to keep those around.
+    if cacheable and not failures:
+        cache_template(text, compile_template(text))
+
     # If expansion changed the text, try to expand it again.
     if result != text:
-        result = expand_text(expander, result)
+        result = expand_text(expander, result, rescan=True)
 
     return result
 
 
+def is_name(text):
+    return text.isidentifier() and not keyword.iskeyword(text)
+
+
+def compile_macro(macro):
+    """Turns a "{macro}" string into a function that evaluates it against an Expander. The vast
+    majority of macros are plain names or calls with plain names as arguments, and those we can
+    look up directly instead of paying for a trip through eval(). Results are cached per unique
+    macro."""
+
+    evaluator = macro_cache.get(macro, None)
+    if evaluator is not None:
+        return evaluator
+
+    body = macro[1:-1].strip()
+    call = call_regex.fullmatch(body)
+    args = [arg.strip() for arg in call.group(2).split(",")] if call else []
+    if args == [""]:
+        args = []
+
+    if is_name(body):
+        def lookup_name(expander):
+            return expander.get(body)
+        evaluator = lookup_name
+    elif call and is_name(call.group(1)) and all(is_name(arg) for arg in args):
+        func_name = call.group(1)
+        def call_func(expander):
+            func = expander.get(func_name)
+            return func(*[expander.get(arg) for arg in args])
+        evaluator = call_func
+    else:
+        # eval() strips leading blanks from source strings, compile() does not.
+        code = compile(macro[1:-1].lstrip(" \t"), macro, "eval", dont_inherit=True)
+        def eval_code(expander):
+            return eval(code, {}, expander)  # pylint: disable=eval-used
+        evaluator = eval_code
+
+    macro_cache[macro] = evaluator
+    return evaluator
+
+
 def expand_macro(expander, macro):
     """Evaluates the contents of a "{macro}" string. If eval throws an exception, the macro is
     returned unchanged."""
@@ -586,9 +1121,10 @@ def expand_macro(expander, macro):
     failed = False
 
     try:
-        result = eval(macro[1:-1], {}, expander)  # pylint: disable=eval-used
+        result = compile_macro(macro)(expander)
     except BaseException:  # pylint: disable=broad-exception-caught
         failed = True
+        app.macro_failures += 1
 
     # ==========
 
@@ -601,6 +1137,68 @@ def expand_macro(expander, macro):
     return result
 
 
+def expand_name(expander, name, macro):
+    """expand_macro() for macros that are just a name, which is most of them. Templates call this
+    directly so those skip looking up a compiled macro."""
+
+    if expander.trace:
+        return expand_macro(expander, macro)
+    expand_inc()
+    try:
+        result = expander.get(name)
+    except BaseException:  # pylint: disable=broad-exception-caught
+        result = macro
+        app.macro_failures += 1
+    expand_dec()
+    return result
+
+
+def expand_config(expander, config):
+    return Expander(config)
+
+
+def expand_list(expander, variant):
+    return [expand_variant(expander, val) for val in variant]
+
+
+def expand_dict(expander, variant):
+    return {
+        expand_variant(expander, key): expand_variant(expander, val)
+        for key, val in variant.items()
+    }
+
+
+def expand_passthrough(expander, variant):
+    return variant
+
+
+def expand_fallback(expander, variant):
+    """Handles types that aren't in expand_dispatch, including subclasses of the types that are."""
+    if isinstance(variant, Config):
+        return expand_config(expander, variant)
+    elif listlike(variant):
+        return expand_list(expander, variant)
+    elif dictlike(variant):
+        return expand_dict(expander, variant)
+    elif isinstance(variant, str):
+        return expand_text(expander, variant)
+    return variant
+
+
+# expand_variant() is called on every field of every task, so we dispatch on the exact type of the
+# variant instead of walking a chain of isinstance() checks.
+expand_dispatch = {
+    str:        expand_text,
+    list:       expand_list,
+    dict:       expand_dict,
+    Config:     expand_config,
+    int:        expand_passthrough,
+    float:      expand_passthrough,
+    bool:       expand_passthrough,
+    type(None): expand_passthrough,
+}
+
+
 def expand_variant(expander, variant):
     """Expands all macros anywhere inside 'variant', making deep copies where needed so we don't
     expand someone else's data."""
@@ -610,19 +1208,7 @@ def expand_variant(expander, variant):
     #   log(trace_config(expander) + f"┏ expand_variant {trace_variant(variant)}")
     # expand_inc()
 
-    if isinstance(variant, Config):
-        result = Expander(variant)
-    elif listlike(variant):
-        result = [expand_variant(expander, val) for val in variant]
-    elif dictlike(variant):
-        result = {
-            expand_variant(expander, key): expand_variant(expander, val)
-            for key, val in variant.items()
-        }
-    elif isinstance(variant, str):
-        result = expand_text(expander, variant)
-    else:
-        result = variant
+    result = expand_dispatch.get(type(variant), expand_fallback)(expander, variant)
 
     # expand_dec()
     # if expander.trace:
@@ -698,6 +1284,26 @@ class Task:
         self._stderr = ""
         self._returncode = -1
 
+        # A task's depth is one more than the deepest task it depends on, so leaves are 0. The
+        # queue drains in depth order so that dependencies get started before their dependents.
+        self._depth = 0
+        deps = {}
+
+        def apply(_, val):
+            if isinstance(val, Promise):
+                val = val.task
+            if isinstance(val, Task):
+                self._depth = max(self._depth, val._depth + 1)
+                deps[val] = None
+
+        apply_variant(None, self.config, apply)
+
+        # Tasks only go in the run queue once all the tasks they depend on are done, so workers
+        # never sit waiting on a task that can't run yet.
+        self._deps = list(deps)
+        self._pending_deps = 0
+        self._downstream = []
+
         app.all_tasks.append(self)
 
         #if self.config.get("queue", False):
@@ -712,30 +1318,45 @@ class Task:
     def __deepcopy__(self, memo):
         return self
 
+    # Dumping a whole task is expensive, so repr() just identifies it and dump() is for when we
+    # actually want to print the task's contents.
     def __repr__(self):
+        return f"{type(self).__name__} @ {hex(id(self))}"
+
+    def dump(self):
         return Dumper(2).dump(self)
 
     # ----------------------------------------
 
     def queue(self):
         if self._state is TaskState.DECLARED:
-            app.queued_tasks.append(self)
             self._state = TaskState.QUEUED
-
-            def apply(_, val):
-                if isinstance(val, Task):
-                    val.queue()
-                return val
-
-            map_variant(None, self.config, apply)
+            app.tasks_queued += 1
+            for dep in self._deps:
+                dep.queue()
+                if dep.asyncio_task is None or not dep.asyncio_task.done():
+                    self._pending_deps += 1
+                    dep._downstream.append(self)
+            if self._pending_deps == 0:
+                app.push_task(self)
 
     def start(self):
         self.queue()
         if self._state is TaskState.QUEUED:
             self.asyncio_task = asyncio.create_task(self.task_main())
+            self.asyncio_task.add_done_callback(self.on_done)
             self._state = TaskState.STARTED
             app.tasks_started += 1
 
+    def on_done(self, _):
+        # Failed and cancelled tasks count as done too, their downstream tasks still have to run
+        # to find out they've been cancelled.
+        for task in self._downstream:
+            task._pending_deps -= 1
+            if task._pending_deps == 0:
+                app.push_task(task)
+        self._downstream = []
+
     async def await_done(self):
         self.start()
         await self.asyncio_task
@@ -749,7 +1370,7 @@ class Task:
         """Print the "[1/N] Compiling foo.cpp -> foo.o" status line and debug information"""
         verbosity = self.config.get("verbosity", app.flags.verbosity)
         log(
-            f"{color(128,255,196)}[{self._task_index}/{app.tasks_started}]{color()} {self.config.desc}",
+            f"{color(128,255,196)}[{self._task_index}/{app.tasks_queued}]{color()} {self.config.desc}",
             sameline=verbosity == 0,
         )
 
@@ -818,7 +1439,7 @@ class Task:
             if verbosity or debug:
                 log(f"{color(128,128,128)}Reason: {self._reason}{color()}")
 
-            for command in flatten(self.config.command):
+            for command in flat_view(self.config.command):
                 await self.run_command(command)
                 if self._returncode != 0:
                     break
@@ -829,7 +1450,17 @@ class Task:
             app.tasks_failed += 1
             raise ex
         finally:
-            await app.job_pool.release_jobs(job_count, self)
+            try:
+                # Our commands may have added or changed files in our output directories.
+                # Callbacks can put other things than filenames in out_files (like Tasks), so
+                # we skip those.
+                for file in self.out_files:
+                    if isinstance(file, str):
+                        forget_file(file)
+                if isinstance(in_depfile := self.config.get("in_depfile", None), str):
+                    forget_file(abs_path(in_depfile))
+            finally:
+                await app.job_pool.release_jobs(job_count, self)
 
         # Task finished successfully
         self._state = TaskState.FINISHED
@@ -843,7 +1474,7 @@ class Task:
         debug = self.config.get("debug", app.flags.debug)
 
         if debug:
-            log(f"\nTask before expand: {self}")
+            log(f"\nTask before expand: {self.dump()}")
 
         # ----------------------------------------
         # Expand task_dir and build_dir
@@ -876,52 +1507,57 @@ class Task:
                     return val
                 self.config[key] = map_variant(key, val, expand_path)
 
-        # Make all in_ and out_ file paths absolute
+        # Make all in_ and out_ file paths absolute, gathering inputs into task.in_files and outputs
+        # into task.out_files in the same pass.
 
         # FIXME feeling like in_depfile should really be io_depfile...
 
-        for key, val in self.config.items():
-            if key.startswith("out_") or key == "in_depfile":
-                def move_to_builddir(_, val):
-                    if not isinstance(val, str):
-                        return val
-                    # Note this conditional needs to be first, as build_dir can itself be under
-                    # task_dir
-                    if val.startswith(self.config.build_dir):
-                        # Absolute path under build_dir, do nothing.
-                        pass
-                    elif val.startswith(self.config.task_dir):
-                        # Absolute path under task_dir, move to build_dir
-                        val = rel_path(val, self.config.task_dir)
-                        val = join_path(self.config.build_dir, val)
-                    elif path.isabs(val):
-                        raise ValueError(f"Output file has absolute path that is not under task_dir or build_dir : {val}")
-                    else:
-                        # Relative path, add build_dir
-                        val = join_path(self.config.build_dir, val)
-                    return val
-                self.config[key] = map_variant(key, val, move_to_builddir)
-            elif key.startswith("in_"):
-                def move_to_taskdir(key, val):
-                    if not isinstance(val, str):
-                        return val
-                    if not path.isabs(val):
-                        val = join_path(self.config.task_dir, val)
-                    return val
-                self.config[key] = map_variant(key, val, move_to_taskdir)
+        def move_to_builddir(val):
+            # Note this conditional needs to be first, as build_dir can itself be under task_dir
+            if val.startswith(self.config.build_dir):
+                # Absolute path under build_dir, do nothing.
+                pass
+            elif val.startswith(self.config.task_dir):
+                # Absolute path under task_dir, move to build_dir
+                val = rel_path(val, self.config.task_dir)
+                val = join_path(self.config.build_dir, val)
+            elif path.isabs(val):
+                raise ValueError(f"Output file has absolute path that is not under task_dir or build_dir : {val}")
+            else:
+                # Relative path, add build_dir
+                val = join_path(self.config.build_dir, val)
+            return val
+
+        def move_to_taskdir(val):
+            if not path.isabs(val):
+                val = join_path(self.config.task_dir, val)
+            return val
 
-        # Gather all inputs to task.in_files and outputs to task.out_files
+        def move_and_gather(move, files):
+            def apply(_, val):
+                if not isinstance(val, str):
+                    # Non-string files (pathlib.Path, etc.) still get gathered, just not moved.
+                    if val is not None and not listlike(val) and not dictlike(val):
+                        files.append(val)
+                    return val
+                val = move(val)
+                files.append(val)
+                return val
+            return apply
 
         for key, val in self.config.items():
-            # Note - we only add the depfile to in_files _if_it_exists_, otherwise we will fail a check
-            # that all our inputs are present.
             if key == "in_depfile":
-                if path.isfile(val):
-                    self.in_files.append(val)
+                # Note - we only add the depfile to in_files _if_it_exists_, otherwise we will fail
+                # a check that all our inputs are present.
+                depfiles = []
+                self.config[key] = map_variant(key, val, move_and_gather(move_to_builddir, depfiles))
+                self.in_files.extend(file for file in depfiles if file_isfile(file))
             elif key.startswith("out_"):
-                self.out_files.extend(flatten(val))
+                gather = move_and_gather(move_to_builddir, self.out_files)
+                self.config[key] = map_variant(key, val, gather)
             elif key.startswith("in_"):
-                self.in_files.extend(flatten(val))
+                gather = move_and_gather(move_to_taskdir, self.in_files)
+                self.config[key] = map_variant(key, val, gather)
 
         # ----------------------------------------
         # And now we can expand the command.
@@ -930,7 +1566,7 @@ class Task:
         self.config.command = self.config.expand(self.config.command)
 
         if debug:
-            log(f"\nTask after expand: {self}")
+            log(f"\nTask after expand: {self.dump()}")
 
         # ----------------------------------------
         # Check for task collisions
@@ -938,11 +1574,18 @@ class Task:
         # FIXME need a test for this that uses symlinks
 
         if self.out_files and self.config.command is not None:
-            for file in self.out_files:
-                file = path.realpath(file)
-                if file in app.filename_to_fingerprint:
-                    raise ValueError(f"TaskCollision: Multiple tasks build {file}")
-                app.filename_to_fingerprint[file] = self.config.command
+            real_files = dict.fromkeys(path.realpath(file) for file in self.out_files)
+            if collisions := app.filename_to_fingerprint.keys() & real_files.keys():
+                raise ValueError(f"TaskCollision: Multiple tasks build {next(iter(collisions))}")
+            if len(real_files) < len(self.out_files):
+                # Some file is listed more than once in this task, go find it.
+                seen = set()
+                for file in self.out_files:
+                    file = path.realpath(file)
+                    if file in seen:
+                        raise ValueError(f"TaskCollision: Multiple tasks build {file}")
+                    seen.add(file)
+            app.filename_to_fingerprint.update(dict.fromkeys(real_files, self.config.command))
 
         # ----------------------------------------
         # Sanity checks
@@ -954,7 +1597,7 @@ class Task:
         for file in self.in_files:
             if file is None:
                 raise ValueError("in_files contained a None")
-            if not path.exists(file):
+            if not file_exists(file):
                 raise FileNotFoundError(file)
 
         # Check that all build files would end up under build_dir
@@ -968,15 +1611,14 @@ class Task:
 
         # Check for duplicate task outputs
         if self.config.command:
-            for file in self.out_files:
-                #if file in app.all_out_files:
-                #    raise NameError(f"Multiple rules build {file}!")
-                app.all_out_files.add(file)
+            #if dupes := app.all_out_files.intersection(self.out_files):
+            #    raise NameError(f"Multiple rules build {next(iter(dupes))}!")
+            app.all_out_files.update(self.out_files)
 
         # Make sure our output directories exist
         if not app.flags.dry_run:
             for file in self.out_files:
-                os.makedirs(path.dirname(file), exist_ok=True)
+                make_dirs(path.dirname(file))
 
     # -----------------------------------------------------------------------------------------------
 
@@ -994,47 +1636,27 @@ class Task:
 
         # Check if any of our output files are missing.
         for file in self.out_files:
-            if not path.exists(file):
+            if not file_exists(file):
                 return f"Rebuilding because {file} is missing"
 
         # Check if any of our input files are newer than the output files.
         min_out = min(mtime(f) for f in self.out_files)
 
-        if mtime(__file__) >= min_out:
-            return "Rebuilding because hancho.py has changed"
-
-        for file in self.in_files:
-            if mtime(file) >= min_out:
-                return f"Rebuilding because {file} has changed"
-
-        for mod_filename in self._loaded_files:
-            if mtime(mod_filename) >= min_out:
-                return f"Rebuilding because {mod_filename} has changed"
+        if (changed := find_newer([__file__, *self.in_files, *self._loaded_files], min_out)):
+            if changed == __file__:
+                return "Rebuilding because hancho.py has changed"
+            return f"Rebuilding because {changed} has changed"
 
         # Check all dependencies in the C dependencies file, if present.
-        if (in_depfile := self.config.get("in_depfile", None)) and path.exists(
-            in_depfile
-        ):
+        if (in_depfile := self.config.get("in_depfile", None)) and file_exists(in_depfile):
             depformat = self.config.get("depformat", "gcc")
             if debug:
                 log(f"Found C dependencies file {in_depfile}")
-            with open(in_depfile, encoding="utf-8") as depfile:
-                deplines = None
-                if depformat == "msvc":
-                    # MSVC /sourceDependencies
-                    deplines = json.load(depfile)["Data"]["Includes"]
-                elif depformat == "gcc":
-                    # GCC -MMD
-                    deplines = depfile.read().split()
-                    deplines = [d for d in deplines[1:] if d != "\\"]
-                else:
-                    raise ValueError(f"Invalid dependency file format {depformat}")
-
-                # The contents of the C dependencies file are RELATIVE TO THE WORKING DIRECTORY
-                deplines = [path.join(self.config.task_dir, d) for d in deplines]
-                for abs_file in deplines:
-                    if mtime(abs_file) >= min_out:
-                        return f"Rebuilding because {abs_file} has changed"
+            # The contents of the C dependencies file are RELATIVE TO THE WORKING DIRECTORY
+            deps = read_depfile(in_depfile, depformat)
+            deps = [path.join(self.config.task_dir, dep) for dep in deps]
+            if (changed := find_newer(deps, min_out)):
+                return f"Rebuilding because {changed} has changed"
 
         # All checks passed; we don't need to rebuild this output.
         # Empty string = no reason to rebuild
@@ -1060,8 +1682,10 @@ class Task:
         if app.flags.dry_run:
             return
 
-        # Custom commands just get called and then early-out'ed.
+        # Custom commands just get called and then early-out'ed. They can print() whatever they
+        # like, so anything we've logged about this task needs to be out before they run.
         if callable(command):
+            sync_log()
             app.pushdir(self.config.task_dir)
             result = command(self)
             while inspect.isawaitable(result):
@@ -1078,20 +1702,26 @@ class Task:
         if debug:
             log(f"Task {hex(id(self))} subprocess start '{command}'")
 
-        proc = await asyncio.create_subprocess_shell(
-            command,
-            cwd=self.config.task_dir,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        (stdout_data, stderr_data) = await proc.communicate()
+        if app.shell_pool is not None:
+            (stdout_data, stderr_data, returncode) = await app.shell_pool.run(
+                command, self.config.task_dir
+            )
+        else:
+            proc = await asyncio.create_subprocess_shell(
+                command,
+                cwd=self.config.task_dir,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            (stdout_data, stderr_data) = await proc.communicate()
+            returncode = proc.returncode
 
         if debug:
             log(f"Task {hex(id(self))} subprocess done '{command}'")
 
         self._stdout = stdout_data.decode()
         self._stderr = stderr_data.decode()
-        self._returncode = proc.returncode
+        self._returncode = returncode
 
         # We need a better way to handle "should fail" so we don't constantly keep rerunning
         # intentionally-failing tests every build
@@ -1109,7 +1739,7 @@ class Task:
 
         if debug or verbosity:
             log(
-                f"{color(128,255,196)}[{self._task_index}/{app.tasks_started}]{color()} Task passed - '{self.config.desc}'"
+                f"{color(128,255,196)}[{self._task_index}/{app.tasks_queued}]{color()} Task passed - '{self.config.desc}'"
             )
             if self._stdout:
                 log("Stdout:")
@@ -1170,10 +1800,12 @@ def create_mod(parent, mod_path):
         mod_path = mod_path,
     )
 
-    new_context = copy.deepcopy(parent)
+    # Seeding the memo makes deepcopy() substitute new_config for the parent's config instead of
+    # copying the whole parent config just to throw it away.
+    new_context = copy.deepcopy(parent, {id(parent.config): new_config})
     new_context.is_repo = False
 
-    new_context.config = new_config
+    assert new_context.config is new_config
     return new_context
 
 ####################################################################################################
@@ -1198,6 +1830,12 @@ class HanchoAPI(Utils):
             return arg1(self, **temp_config)
         return Task(self.config, arg1, *args, **kwargs)
 
+    def glob(self, pattern, **kwargs):
+        """glob() relative to this module's directory instead of the current directory, unless the
+        caller passes its own root_dir."""
+        kwargs.setdefault("root_dir", self.config.mod_dir)
+        return glob_files(pattern, **kwargs)
+
 
 
     def repo(self, mod_path):
@@ -1240,22 +1878,35 @@ class HanchoAPI(Utils):
         app.loaded_files.append(self.config.mod_path)
 
         # We're using compile() and FunctionType()() here beause exec() doesn't preserve source
-        # code for debugging.
-        file = open(self.config.mod_path, encoding="utf-8")
-        source = file.read()
-        code = compile(source, self.config.mod_path, "exec", dont_inherit=True)
+        # code for debugging. Shared rule files tend to get load()ed by lots of other .hancho
+        # files, so we keep the compiled code for the rest of the run. The cache is keyed on the
+        # source itself so we never run stale code for a file that changed.
+        mod_path = self.config.mod_path
+        with open(mod_path, encoding="utf-8") as file:
+            source = file.read()
+        code = app.code_cache.get((mod_path, source), None)
+        if code is None:
+            code = compile(source, mod_path, "exec", dont_inherit=True)
+            app.code_cache[(mod_path, source)] = code
+        temp_globals = {"hancho": self, "__builtins__": builtins}
 
         # We must chdir()s into the .hancho file directory before running it so that
-        # glob() can resolve files relative to the .hancho file itself. We are _not_ in an async
+        # glob() can resolve files relative to the .hancho file itself. New .hancho files can use
+        # hancho.glob() instead, which doesn't depend on cwd. We are _not_ in an async
         # context here so there should be no other threads trying to change cwd.
         app.pushdir(path.dirname(self.config.mod_path))
-        temp_globals = {"hancho": self, "__builtins__": builtins}
 
         # Pylint is just wrong here
         # pylint: disable=not-callable
         types.FunctionType(code, temp_globals)()
         app.popdir()
 
+        # Most of the files a .hancho file mentions live next to it, so list its directory once
+        # the module is done running (it may have generated files of its own). The mtime checks
+        # when its tasks run then hit the cached listing.
+        forget_dir(path.dirname(self.config.mod_path))
+        dir_entries(path.dirname(self.config.mod_path))
+
         # Module loaded, turn the module's globals into a Config that doesn't include __builtins__,
         # hancho, and imports so we don't have files that end up transitively containing the
         # universe
@@ -1273,13 +1924,16 @@ class HanchoAPI(Utils):
 
 class JobPool:
     def __init__(self):
-        self.jobs_available = os.cpu_count()
-        self.jobs_lock = asyncio.Condition()
-        self.job_slots = [None] * self.jobs_available
+        self.reset(os.cpu_count())
 
     def reset(self, job_count):
-        self.jobs_available = job_count
-        self.job_slots = [None] * self.jobs_available
+        self.jobs_free = job_count
+        # Tasks waiting for jobs, as (count, future) pairs. Waiters are served in order, but a
+        # waiter that fits in the free jobs doesn't have to wait behind one that doesn't. A task
+        # holding jobs can be waiting on a task that needs fewer, so serving strictly in order
+        # could deadlock.
+        self.waiters = deque()
+        self.job_slots = [None] * job_count
 
     ########################################
 
@@ -1289,8 +1943,24 @@ class JobPool:
         if count > app.flags.jobs:
             raise ValueError(f"Need {count} jobs, but pool is {app.flags.jobs}.")
 
-        await self.jobs_lock.acquire()
-        await self.jobs_lock.wait_for(lambda: self.jobs_available >= count)
+        # Fast path, there are enough jobs free. We don't have to suspend at all. Any waiters
+        # still queued need more jobs than are free, so we're not cutting in front of them.
+        if self.jobs_free >= count:
+            self.jobs_free -= count
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append((count, waiter))
+            try:
+                await waiter
+            except BaseException:
+                if not waiter.cancelled():
+                    # We were handed our jobs right as we got cancelled, give them back.
+                    self.jobs_free += count
+                elif (count, waiter) in self.waiters:
+                    self.waiters.remove((count, waiter))
+                # Either way, the tasks behind us might be able to go now.
+                self.wake_waiters()
+                raise
 
         slots_remaining = count
         for i, val in enumerate(self.job_slots):
@@ -1298,34 +1968,120 @@ class JobPool:
                 self.job_slots[i] = token
                 slots_remaining -= 1
 
-        self.jobs_available -= count
-        self.jobs_lock.release()
-
     ########################################
-    # NOTE: The notify_all here is required because we don't know in advance which tasks will
-    # be capable of running after we return jobs to the pool. HOWEVER, this also creates an
-    # O(N^2) slowdown when we have a very large number of pending tasks (>1000) due to the
-    # "Thundering Herd" problem - all tasks will wake up, only a few will acquire jobs, the
-    # rest will go back to sleep again, this will repeat for every call to release_jobs().
+    # Returning jobs only wakes up the waiters that can actually run with them, instead of waking
+    # every waiting task and sending most of them back to sleep.
 
     async def release_jobs(self, count, token):
-        """Returns 'count' jobs back to the job pool."""
+        """Returns the jobs held by 'token' back to the job pool."""
 
-        await self.jobs_lock.acquire()
-        self.jobs_available += count
-
-        slots_remaining = count
+        # We go by the slots 'token' actually holds, not 'count', so that a task that got
+        # cancelled before it acquired its jobs doesn't release jobs it never had.
         for i, val in enumerate(self.job_slots):
-            if val == token:
+            if val is token:
                 self.job_slots[i] = None
-                slots_remaining -= 1
+                self.jobs_free += 1
+        self.wake_waiters()
+
+    def wake_waiters(self):
+        still_waiting = deque()
+        while self.waiters and self.jobs_free:
+            count, waiter = self.waiters.popleft()
+            if waiter.done():
+                # Cancelled while waiting
+                continue
+            if count > self.jobs_free:
+                still_waiting.append((count, waiter))
+                continue
+            self.jobs_free -= count
+            waiter.set_result(None)
+        still_waiting.extend(self.waiters)
+        self.waiters = still_waiting
+
+
+####################################################################################################
+
 
-        self.jobs_lock.notify_all()
-        self.jobs_lock.release()
+class ShellPool:
+    """Runs commands on a pool of long-lived /bin/sh processes instead of spawning a new shell for
+    every command. Each command runs in its own subshell so it can't leave the worker's cwd or
+    variables changed, and goes through 'eval' so a command with a syntax error can't kill the
+    worker. Commands get /dev/null as stdin, since the worker's stdin is how we talk to it."""
+
+    def __init__(self):
+        self.idle_shells = []
+        self.all_shells = []
+        self.sentinel = f"__HANCHO_{os.getpid()}_{random.getrandbits(64):016x}__"
+
+    async def spawn(self):
+        shell = await asyncio.create_subprocess_exec(
+            "/bin/sh",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        self.all_shells.append(shell)
+        return shell
+
+    async def read_until(self, stream, marker):
+        """Reads 'stream' until 'marker' shows up and returns everything before it."""
+        data = bytearray()
+        while True:
+            chunk = await stream.read(65536)
+            if not chunk:
+                raise EOFError("Shell pool worker exited unexpectedly")
+            data += chunk
+            index = data.find(marker, max(0, len(data) - len(chunk) - len(marker)))
+            if index >= 0:
+                return bytes(data[:index])
+
+    async def run(self, command, cwd):
+        """Runs 'command' in 'cwd', returns (stdout_data, stderr_data, returncode)."""
+
+        shell = self.idle_shells.pop() if self.idle_shells else await self.spawn()
+        sentinel = self.sentinel
+        script = (
+            f"( cd {shlex.quote(cwd)} && eval {shlex.quote(command)} ) </dev/null\n"
+            f"printf '\\n%d {sentinel}\\n' $?\n"
+            f"printf '\\n{sentinel}\\n' >&2\n"
+        )
+
+        try:
+            shell.stdin.write(script.encode())
+            await shell.stdin.drain()
+            (stdout_data, stderr_data) = await asyncio.gather(
+                self.read_until(shell.stdout, f" {sentinel}\n".encode()),
+                self.read_until(shell.stderr, f"\n{sentinel}\n".encode()),
+            )
+        except BaseException:
+            # We don't know what state the worker is in now, so don't reuse it.
+            if shell.returncode is None:
+                shell.kill()
+            raise
+
+        # The last line of stdout is the newline + return code we printed after the command.
+        (stdout_data, _, returncode) = stdout_data.rpartition(b"\n")
+        self.idle_shells.append(shell)
+        return (stdout_data, stderr_data, int(returncode))
+
+    async def close(self):
+        for shell in self.all_shells:
+            if shell.returncode is None:
+                shell.stdin.close()
+            await shell.wait()
+        self.idle_shells = []
+        self.all_shells = []
 
 
 ####################################################################################################
 
+# Matches unrecognized command line flags like "--foo" or "--foo=bar"
+flag_regex = re.compile(r"-+([^=\s]+)(?:=(\S+))?")
+
+# Which of App's task workers we're running under, if any. Asyncio tasks inherit this from
+# whatever started them, so tasks queued while a task runs know which worker it belongs to.
+worker_id = contextvars.ContextVar("worker_id", default=None)
+
 
 class App:
 
@@ -1336,6 +2092,7 @@ class App:
 
         self.root_context = None
         self.loaded_files = []
+        self.code_cache = {}
         self.dirstack = [os.getcwd()]
 
         self.all_out_files = set()
@@ -1344,10 +2101,21 @@ class App:
         self.realpath_to_repo = {}
 
         self.mtime_calls = 0
+        self.mtime_cache = {}
+        self.dir_cache = {}
+        self.dirs_made = set()
+        self.depfile_cache = {}
         self.line_dirty = False
+        self.term_cols = None
+        self.term_cols_age = 0
         self.expand_depth = 0
+        self.macro_failures = 0
         self.shuffle = False
+        self.push_task = self.push_task_ordered
 
+        # Every task queued so far, which is what the "[N/M]" status lines count up to. Tasks only
+        # get started once a worker picks them up, so tasks_started would lag behind.
+        self.tasks_queued = 0
         self.tasks_started = 0
         self.tasks_running = 0
         self.tasks_finished = 0
@@ -1358,15 +2126,37 @@ class App:
 
         self.all_tasks = []
         self.queued_tasks = []
-        self.started_tasks = []
+        self.queue_counter = 0
+        self.worker_queues = []
+        self.worker_tasks = []
+        self.busy_workers = 0
+        self.work_added = None
+        self.stopping = False
+        self.workers_cancelled = False
         self.finished_tasks = []
-        self.log = ""
+        self.log_lines = []
+        self.log_queue = None
+        self.log_writer = None
+        self.log_error = None
+        self.log_buffer = []
+        self.log_flush_pending = False
 
         self.job_pool = JobPool()
+        self.shell_pool = None
         self.parse_flags([])
 
     def reset(self):
         self.__init__()  # pylint: disable=unnecessary-dunder-call
+        # Compiled templates and macros don't depend on app state, but they'd otherwise grow
+        # forever across builds.
+        template_cache.clear()
+        macro_cache.clear()
+
+    @property
+    def log(self):
+        """Everything we've logged so far. Lines are kept in a list so that logging stays linear
+        in the size of the log."""
+        return "".join(self.log_lines)
 
     ########################################
 
@@ -1391,6 +2181,7 @@ class App:
         parser.add_argument("--use_color",       default=False, action="store_true",  help="Use color in the console output")
         parser.add_argument("-t", "--tool",      default=None, type=str,   help="Run a subtool.")
         parser.add_argument("-k", "--keep_going", default=1,  type=int,   help="Keep going until N jobs fail (0 means infinity)")
+        parser.add_argument("--shell_pool",      default=False, action="store_true",  help="Run commands on a pool of persistent shells (commands get no stdin)")
 
         # fmt: on
 
@@ -1400,13 +2191,14 @@ class App:
         # flag-like
         extra_flags = {}
         for span in unrecognized:
-            if match := re.match(r"-+([^=\s]+)(?:=(\S+))?", span):
+            if match := flag_regex.match(span):
                 key = match.group(1)
                 val = match.group(2)
                 val = maybe_as_number(val) if val is not None else True
                 extra_flags[key] = val
 
         self.flags = flags
+        self.shuffle = flags.shuffle
         self.extra_flags = extra_flags
 
     ########################################
@@ -1431,6 +2223,7 @@ class App:
     ########################################
 
     def main(self):
+        watch_resize()
         app.root_context = self.create_root_context()
 
         if app.root_context.config.get("debug", None):
@@ -1509,7 +2302,7 @@ class App:
         time_b = time.perf_counter()
 
         # if app.flags.debug or app.flags.verbosity:
-        log(f"Queueing {len(app.queued_tasks)} tasks took {time_b-time_a:.3f} seconds")
+        log(f"Queueing {app.queued_count()} tasks took {time_b-time_a:.3f} seconds")
 
         result = self.build()
         return result
@@ -1532,8 +2325,23 @@ class App:
         result = -1
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
-        result = asyncio.run(self.async_run_tasks())
-        loop.close()
+        if not self.flags.quiet:
+            start_log_writer()
+        succeeded = False
+        try:
+            result = asyncio.run(self.async_run_tasks())
+            succeeded = True
+        finally:
+            try:
+                stop_log_writer()
+            except Exception:  # pylint: disable=broad-exception-caught
+                # If the build itself blew up, that's the error worth reporting, not this one.
+                if succeeded:
+                    raise
+            finally:
+                loop.close()
+        # Anything logged at the very end of the run may not have been flushed by the event loop.
+        flush_log()
         return result
 
     def build_all(self):
@@ -1543,46 +2351,149 @@ class App:
 
     ########################################
 
-    async def async_run_tasks(self):
-        # Run all tasks in the queue until we run out.
-
-        self.job_pool.reset(self.flags.jobs)
-
-        # Tasks can create other tasks, and we don't want to block waiting on a whole batch of
-        # tasks to complete before queueing up more. Instead, we just keep queuing up any pending
-        # tasks after awaiting each one. Because we're awaiting tasks in the order they were
-        # created, this will effectively walk through all tasks in dependency order.
-
-        time_a = time.perf_counter()
-
-        while self.queued_tasks or self.started_tasks:
-            if app.shuffle:
-                log(f"Shufflin' {len(self.queued_tasks)} tasks")
-                random.shuffle(self.queued_tasks)
-
-            while self.queued_tasks:
-                task = self.queued_tasks.pop(0)
-                task.start()
-                self.started_tasks.append(task)
+    def queued_count(self):
+        """The number of tasks queued but not started yet. Tasks still waiting on dependencies
+        aren't in queued_tasks, so we count by state instead."""
+        return sum(task._state is TaskState.QUEUED for task in self.all_tasks)
+
+    def push_task_ordered(self, task):
+        """Tasks queued while loading go in the shared queue. Tasks queued by a running task go on
+        the queue of the worker running it, so they run close to the task that made them."""
+        worker = worker_id.get()
+        if worker is None:
+            heapq.heappush(self.queued_tasks, (task._depth, self.queue_counter, task))
+            self.queue_counter += 1
+        else:
+            self.worker_queues[worker].append(task)
+        if self.work_added is not None:
+            self.work_added.set()
+
+    def push_task_shuffled(self, task):
+        """push_task_ordered() for --shuffle, tasks of the same depth come out in random order."""
+        worker = worker_id.get()
+        if worker is None:
+            heapq.heappush(self.queued_tasks, (task._depth, random.random(), task))
+        else:
+            local = self.worker_queues[worker]
+            local.insert(random.randrange(len(local) + 1), task)
+        if self.work_added is not None:
+            self.work_added.set()
+
+    def next_task(self, worker):
+        """Workers run their own newest tasks first, then the shared queue, then steal the oldest
+        task from some other worker."""
+        if self.worker_queues[worker]:
+            return self.worker_queues[worker].pop()
+        if self.queued_tasks:
+            return heapq.heappop(self.queued_tasks)[2]
+        start = random.randrange(len(self.worker_queues))
+        for i in range(len(self.worker_queues)):
+            victim = self.worker_queues[(start + i) % len(self.worker_queues)]
+            if victim:
+                return victim.popleft()
+        return None
+
+    async def run_worker(self, worker):
+        worker_id.set(worker)
+        while not self.stopping:
+            task = self.next_task(worker)
+            if task is None:
+                # Only running tasks can queue more tasks. If nothing's running, we're done.
+                if self.busy_workers == 0:
+                    self.work_added.set()
+                    return
+                self.work_added.clear()
+                await self.work_added.wait()
+                continue
 
-            task = self.started_tasks.pop(0)
+            self.busy_workers += 1
+            self.worker_tasks[worker] = task
             try:
+                task.start()
                 await task.asyncio_task
             except BaseException:  # pylint: disable=broad-exception-caught
+                if self.workers_cancelled:
+                    # The supervisor is shutting us down, this isn't a task failure.
+                    raise
+                if self.stopping:
+                    return
                 log(color(255, 128, 0), end="")
                 log(f"Task failed: {task.config.desc}")
                 log(color(), end="")
-                log(str(task))
+                log(task.dump())
                 log_exception()
                 fail_count = app.tasks_failed + app.tasks_cancelled + app.tasks_broken
                 if app.flags.keep_going and fail_count >= app.flags.keep_going:
                     log("Too many failures, cancelling tasks and stopping build")
-                    for task in self.started_tasks:
-                        task.asyncio_task.cancel()
-                        app.tasks_cancelled += 1
-                    break
+                    self.stopping = True
+                    self.work_added.set()
+                    for other in self.worker_tasks:
+                        if other is not None and other is not task:
+                            other.asyncio_task.cancel()
+                            app.tasks_cancelled += 1
+            finally:
+                self.busy_workers -= 1
+                self.worker_tasks[worker] = None
             self.finished_tasks.append(task)
 
+    async def async_run_tasks(self):
+        # Run all tasks in the queue until we run out.
+
+        self.job_pool.reset(self.flags.jobs)
+        if self.flags.shell_pool:
+            self.shell_pool = ShellPool()
+
+        # Tasks are run by a fixed set of worker coroutines so the event loop isn't juggling
+        # thousands of coroutines that are all waiting on jobs. Tasks outside the workers still
+        # get started early if a running task depends on them. The shared queue is a heap ordered
+        # by task depth (and then by queue order), so workers walk through all tasks in dependency
+        # order. Tasks can create other tasks, those go on the creating worker's own queue.
+        worker_count = max(1, self.flags.jobs * 4)
+        self.worker_queues = [deque() for _ in range(worker_count)]
+        self.worker_tasks = [None] * worker_count
+        self.busy_workers = 0
+        self.work_added = asyncio.Event()
+        self.stopping = False
+        self.workers_cancelled = False
+
+        # Shuffling is decided once up front, the rest of the run pushes tasks through whichever
+        # version of push_task we pick here instead of checking the flag every time.
+        if self.shuffle:
+            # Tasks still have to come out in depth order, so we only shuffle within a depth.
+            log(f"Shufflin' {self.queued_count()} tasks")
+            self.queued_tasks = [(d, random.random(), t) for d, _, t in self.queued_tasks]
+            heapq.heapify(self.queued_tasks)
+            self.push_task = self.push_task_shuffled
+        else:
+            self.push_task = self.push_task_ordered
+
+        time_a = time.perf_counter()
+
+        # Workers only return once there's nothing left to do. If one dies instead, that's a bug in
+        # Hancho and not a task failure, so we stop the other workers right away instead of waiting
+        # for them to finish the build without it.
+        try:
+            workers = {asyncio.create_task(self.run_worker(i)) for i in range(worker_count)}
+            while workers:
+                done, workers = await asyncio.wait(workers, return_when=asyncio.FIRST_COMPLETED)
+                for worker in done:
+                    if worker.exception() is not None:
+                        # Set before cancelling so the other workers can tell our CancelledError
+                        # apart from a task getting cancelled. Task.cancelling() would do, but
+                        # needs 3.11.
+                        self.workers_cancelled = True
+                        for other in workers:
+                            other.cancel()
+                        await asyncio.gather(*workers, return_exceptions=True)
+                        raise worker.exception()
+        finally:
+            self.work_added = None
+            # The shell pool's workers are tied to this event loop, so they have to go even if the
+            # build blew up.
+            if self.shell_pool is not None:
+                await self.shell_pool.close()
+                self.shell_pool = None
+
         time_b = time.perf_counter()
 
         # if app.flags.debug or app.flags.verbosity:
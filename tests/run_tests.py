@@ -1,10 +1,13 @@
 #!/usr/bin/python3
 """Test cases for Hancho"""
 
+import asyncio
+import contextlib
 import sys
 import os
 from os import path
 import random
+import re
 import subprocess
 import unittest
 import shutil
@@ -101,6 +104,28 @@ class TestHancho(unittest.TestCase):
 
     ########################################
 
+    @contextlib.contextmanager
+    def dying_workers(self, good_calls, on_call=None):
+        """Makes the workers raise RuntimeError once they've asked for 'good_calls' tasks.
+        'on_call' is called every time a worker asks for a task."""
+        calls = [0]
+        next_task = hancho_py.app.next_task
+        def broken_next_task(worker):
+            if on_call is not None:
+                on_call()
+            calls[0] += 1
+            if calls[0] > good_calls:
+                raise RuntimeError("worker died")
+            return next_task(worker)
+
+        hancho_py.app.next_task = broken_next_task
+        try:
+            yield
+        finally:
+            del hancho_py.app.next_task
+
+    ########################################
+
     def test_dummy(self):
         self.assertEqual(0, 0)
 
@@ -180,6 +205,42 @@ class TestHancho(unittest.TestCase):
 
     ########################################
 
+    def test_flatten_copies(self):
+        """hancho.flatten() should always return a new list, callers are allowed to modify it."""
+        files = ["a.o", "b.o"]
+        flat = self.hancho.flatten(files)
+        flat.append("c.o")
+        self.assertEqual(["a.o", "b.o"], files)
+
+    ########################################
+
+    def test_long_command_template(self):
+        """Templates with thousands of macros should expand like short ones."""
+        task = self.hancho(
+            command = "echo " + " ".join(["{word}"] * 2000) + " > {rel(out_txt)}",
+            word    = "w",
+            out_txt = "words.txt",
+        )
+        self.assertEqual(0, hancho_py.app.build_all())
+        with open(task.out_files[0], encoding="utf-8") as file:
+            self.assertEqual(["w"] * 2000, file.read().split())
+
+    ########################################
+
+    def test_shell_braces_not_cached(self):
+        """Text whose braces are shell syntax shouldn't end up in the template cache."""
+        for i in range(100):
+            self.hancho(
+                command = "echo ${HOME} " + str(i) + " | awk '{print $1}' > {rel(out_txt)}",
+                out_txt = f"out{i}.txt",
+            )
+        self.assertEqual(0, hancho_py.app.build_all())
+        self.assertTrue(Path("build/out99.txt").exists())
+        self.assertFalse([text for text in hancho_py.template_cache if "HOME" in text])
+        self.assertLessEqual(len(hancho_py.template_cache), hancho_py.TEMPLATE_CACHE_SIZE)
+
+    ########################################
+
     def test_good_build_path(self):
         self.hancho(
             command  = "touch {rel(out_obj)}",
@@ -249,6 +310,37 @@ class TestHancho(unittest.TestCase):
 
     ########################################
 
+    def test_path_inputs(self):
+        """pathlib.Path inputs should still count as inputs for rebuild checks."""
+        def run():
+            hancho_py.app.reset()
+            hancho_py.app.parse_flags(["--quiet"])
+            task = self.hancho(
+                command = "cp {in_src} {out_obj}",
+                in_src  = [Path(path.abspath("src/foo.c"))],
+                out_obj = "foo_copy.c",
+            )
+            self.assertEqual(0, hancho_py.app.build_all())
+            return task
+
+        task = run()
+        self.assertEqual([Path(path.abspath("src/foo.c"))], task.in_files)
+        run()
+        self.assertEqual(0, hancho_py.app.tasks_finished)
+        self.assertEqual(1, hancho_py.app.tasks_skipped)
+
+        hancho_py.app.reset()
+        hancho_py.app.parse_flags(["--quiet"])
+        self.hancho(
+            command = "cp {in_src} {out_obj}",
+            in_src  = [Path(path.abspath("src/does_not_exist.c"))],
+            out_obj = "missing_copy.c",
+        )
+        self.assertNotEqual(0, hancho_py.app.build_all())
+        self.assertTrue("FileNotFoundError" in hancho_py.app.log)
+
+    ########################################
+
     def test_missing_dep(self):
         """Missing dep should fail"""
         bad_task = self.hancho(
@@ -355,6 +447,35 @@ class TestHancho(unittest.TestCase):
 
     ########################################
 
+    def test_chained_rebuild(self):
+        """Rebuilding a task should also rebuild tasks that consume its outputs"""
+        def run():
+            hancho_py.app.reset()
+            hancho_py.app.parse_flags(["--quiet"])
+            first = self.hancho(
+                command = "sleep 0.1 && cp {rel(in_src)} {rel(out_txt)}",
+                in_src  = "build/dummy.txt",
+                out_txt = "first.txt",
+            )
+            self.hancho(
+                command = "sleep 0.1 && cp {rel(in_src)} {rel(out_txt)}",
+                in_src  = first,
+                out_txt = "second.txt",
+            )
+            self.assertEqual(0, hancho_py.app.build_all())
+            return mtime_ns("build/second.txt")
+
+        os.makedirs("build", exist_ok=True)
+        force_touch("build/dummy.txt")
+        mtime1 = run()
+        mtime2 = run()
+        force_touch("build/dummy.txt")
+        mtime3 = run()
+        self.assertEqual(mtime1, mtime2)
+        self.assertLess(mtime2, mtime3)
+
+    ########################################
+
     def test_does_create_output(self):
         """Output files should appear in build/ by default"""
         self.hancho(
@@ -467,6 +588,57 @@ class TestHancho(unittest.TestCase):
 
     ########################################
 
+    def test_shell_pool(self):
+        """Commands run on the shell pool should behave like regular subprocess commands"""
+        hancho_py.app.reset()
+        hancho_py.app.parse_flags(["--quiet", "--shell_pool", "-k0"])
+        self.hancho = hancho_py.app.create_root_context()
+
+        good_task = self.hancho(
+            command = [
+                "cd src",
+                "printf 'no newline' && echo 'to stderr' 1>&2",
+                "touch {rel(out_obj)}",
+            ],
+            in_src  = [],
+            out_obj = "pool_result.txt",
+        )
+        bad_syntax = self.hancho(
+            command = "echo oops )",
+            in_src  = [],
+            out_obj = [],
+        )
+        bad_code = self.hancho(
+            command = "(exit 7)",
+            in_src  = [],
+            out_obj = [],
+        )
+        self.assertNotEqual(0, hancho_py.app.build_all())
+        self.assertEqual(good_task._state, hancho_py.TaskState.FINISHED)
+        self.assertEqual(bad_syntax._state, hancho_py.TaskState.FAILED)
+        self.assertEqual(bad_code._state, hancho_py.TaskState.FAILED)
+        self.assertEqual(bad_code._returncode, 7)
+        self.assertTrue(Path("build/pool_result.txt").exists())
+
+    ########################################
+
+    def test_shell_pool_closed_on_error(self):
+        """The shell pool should be shut down even if the build dies."""
+        hancho_py.app.reset()
+        hancho_py.app.parse_flags(["--quiet", "--shell_pool"])
+        self.hancho = hancho_py.app.create_root_context()
+
+        for i in range(10):
+            self.hancho(command = "sleep 0.1", in_src = [], out_obj = f"dummy{i}.txt")
+        pools = []
+        with self.dying_workers(4, lambda: pools.append(hancho_py.app.shell_pool)):
+            with self.assertRaises(RuntimeError):
+                hancho_py.app.build_all()
+        self.assertIsNone(hancho_py.app.shell_pool)
+        self.assertEqual([], pools[0].all_shells)
+
+    ########################################
+
     def test_sync_command(self):
         """The 'command' field of rules should be OK handling a sync function"""
         def sync_command(task):
@@ -517,6 +689,83 @@ class TestHancho(unittest.TestCase):
 
     ########################################
 
+    def test_glob_from_mod_dir(self):
+        """hancho.glob() should match files relative to the module, not the current directory."""
+        os.makedirs("build", exist_ok=True)
+        force_touch("build/a.txt")
+        force_touch("build/b.txt")
+        force_touch("build/c.cpp")
+        old_cwd = os.getcwd()
+        try:
+            os.chdir("build")
+            files = self.hancho.glob("build/*.txt")
+        finally:
+            os.chdir(old_cwd)
+        self.assertEqual(["build/a.txt", "build/b.txt"], sorted(files))
+
+    ########################################
+
+    def test_glob_root_dir(self):
+        """An explicit root_dir should override the module's directory."""
+        os.makedirs("build/sub", exist_ok=True)
+        force_touch("build/sub/a.txt")
+        force_touch("build/sub/b.cpp")
+        self.assertEqual(["a.txt"], self.hancho.glob("*.txt", root_dir="build/sub"))
+
+    ########################################
+
+    def test_glob_sees_new_files(self):
+        """Globs should see files created after the directory was first listed."""
+        os.makedirs("build", exist_ok=True)
+        force_touch("build/a.txt")
+        self.assertEqual(["build/a.txt"], self.hancho.glob("build/*.txt"))
+        force_touch("build/b.txt")
+        self.assertEqual(["build/a.txt", "build/b.txt"], sorted(self.hancho.glob("build/*.txt")))
+
+    ########################################
+
+    def test_callback_output_order(self):
+        """Output from callbacks should come after the log lines for their task."""
+        os.makedirs("build", exist_ok=True)
+        with open("build/order.hancho", "w", encoding="utf-8") as file:
+            file.write("def callback(task):\n")
+            file.write("    print('CALLBACK OUTPUT')\n")
+            file.write("hancho(command = callback, in_src = [], out_txt = 'order.txt')\n")
+        result = subprocess.run(
+            "python3 ../../hancho.py -v -f order.hancho",
+            shell=True,
+            text=True,
+            capture_output=True,
+            cwd="build",
+            check=False,
+        )
+        self.assertEqual(0, result.returncode)
+        lines = result.stdout.splitlines()
+        reason = next(i for i, line in enumerate(lines) if "Reason:" in line)
+        self.assertLess(reason, lines.index("CALLBACK OUTPUT"))
+
+    ########################################
+
+    def test_callback_cwd(self):
+        """Callbacks should run in their task_dir even if an earlier callback changed directory."""
+        seen = []
+        def wander(task):
+            force_touch(task.out_files[0])
+            os.chdir("/")
+        def check(task):
+            force_touch(task.out_files[0])
+            seen.append(os.getcwd())
+        old_cwd = os.getcwd()
+        try:
+            first = self.hancho(command = wander, in_src = [], out_txt = "first.txt")
+            self.hancho(command = check, in_src = [first], out_txt = "second.txt")
+            self.assertEqual(0, hancho_py.app.build_all())
+        finally:
+            os.chdir(old_cwd)
+        self.assertEqual([old_cwd], seen)
+
+    ########################################
+
     def test_task_creates_task(self):
         """Tasks using callbacks can create new tasks when they run."""
         def callback(task):
@@ -540,6 +789,40 @@ class TestHancho(unittest.TestCase):
 
     ########################################
 
+    def test_callback_adds_task_to_outputs(self):
+        """A callback can put a Task in its own out_files, and that shouldn't break the task."""
+        def callback(task):
+            new_task = self.hancho(
+                command = "touch {rel(out_obj)}",
+                in_src  = [],
+                out_obj = "dummy.txt",
+            )
+            task.out_files.append(new_task)
+
+        self.hancho(command = callback, in_src = [], out_obj = [])
+        self.assertEqual(0, hancho_py.app.build_all())
+        self.assertEqual(1, hancho_py.app.tasks_finished)
+        self.assertEqual(0, hancho_py.app.tasks_failed)
+        self.assertTrue(all(slot is None for slot in hancho_py.app.job_pool.job_slots))
+
+    ########################################
+
+    def test_worker_death_stops_build(self):
+        """If a worker dies, the other workers should stop instead of running more tasks."""
+        for i in range(20):
+            self.hancho(
+                command = "sleep 0.2",
+                in_src  = [],
+                out_obj = f"dummy{i}.txt",
+            )
+        with self.dying_workers(4):
+            with self.assertRaises(RuntimeError):
+                hancho_py.app.build_all()
+        self.assertFalse("Task failed" in hancho_py.app.log)
+        self.assertLessEqual(hancho_py.app.tasks_started, 4)
+
+    ########################################
+
     def test_tons_of_tasks(self):
         """We should be able to queue up 1000+ tasks at once."""
         for i in range(1000):
@@ -555,6 +838,100 @@ class TestHancho(unittest.TestCase):
 
     ########################################
 
+    def test_dependency_depth(self):
+        """Tasks should be queued by depth so that dependencies start before their dependents."""
+        leaf = self.hancho(command = "touch {rel(out_obj)}", in_src = [], out_obj = "leaf.txt")
+        mid = self.hancho(
+            command = "cp {rel(in_src)} {rel(out_obj)}",
+            in_src  = leaf.promise(),
+            out_obj = "mid.txt",
+        )
+        top = self.hancho(
+            command = "cat {rel(in_src)} > {rel(out_obj)}",
+            in_src  = [leaf, mid],
+            out_obj = "top.txt",
+        )
+        self.assertEqual([0, 1, 2], [leaf._depth, mid._depth, top._depth])
+        self.assertEqual(0, hancho_py.app.build_all())
+        self.assertTrue(Path("build/top.txt").exists())
+
+    ########################################
+
+    def test_tasks_wait_for_dependencies(self):
+        """Tasks shouldn't enter the run queue until the tasks they depend on are done."""
+        dep = self.hancho(command = "touch {rel(out_obj)}", in_src = [], out_obj = "dep.txt")
+        user = self.hancho(
+            command = "cp {rel(in_src)} {rel(out_obj)}",
+            in_src  = dep.promise(),
+            out_obj = "user.txt",
+        )
+        user.queue()
+        queued = [task for _, _, task in hancho_py.app.queued_tasks]
+        self.assertEqual([dep], queued)
+        self.assertEqual(1, user._pending_deps)
+        self.assertEqual([user], dep._downstream)
+
+        self.assertEqual(0, hancho_py.app.build_all())
+        self.assertEqual(0, user._pending_deps)
+        self.assertEqual(user._state, hancho_py.TaskState.FINISHED)
+        self.assertTrue(Path("build/user.txt").exists())
+
+    ########################################
+
+    def test_status_denominator(self):
+        """Status lines should count up to every queued task, not just the ones started so far,
+        even though dependent tasks don't start until their dependencies are done."""
+        hancho_py.app.parse_flags(["--quiet", "-j2"])
+        prev = None
+        for i in range(10):
+            prev = self.hancho(
+                desc    = "Task {index}",
+                command = "touch {rel(out_obj)}",
+                in_src  = [] if prev is None else prev.promise(),
+                out_obj = "chain{index}.txt",
+                index   = i,
+            )
+        for i in range(30):
+            self.hancho(
+                desc    = "Task {index}",
+                command = "touch {rel(out_obj)}",
+                in_src  = [],
+                out_obj = "free{index}.txt",
+                index   = 10 + i,
+            )
+        self.assertEqual(0, hancho_py.app.build_all())
+        status = re.findall(r"\[(\d+)/(\d+)\]", hancho_py.app.log)
+        self.assertEqual(40, len(status))
+        self.assertEqual({"40"}, {total for _, total in status})
+
+    ########################################
+
+    def test_failed_dependency_releases_downstream(self):
+        """A failed dependency still counts as done, so its downstream tasks run and get cancelled
+        instead of being left in the queue forever."""
+        hancho_py.app.parse_flags(["--quiet", "-k0"])
+        fails = self.hancho(command = "(exit 255)", in_src = [], out_obj = "fail.txt")
+        passes = self.hancho(command = "touch {rel(out_obj)}", in_src = [], out_obj = "pass.txt")
+        middle = self.hancho(
+            command = "touch {rel(out_obj)}",
+            in_src  = [fails.promise(), passes],
+            out_obj = "middle.txt",
+        )
+        last = self.hancho(
+            command = "touch {rel(out_obj)}",
+            in_src  = middle,
+            out_obj = "last.txt",
+        )
+        self.assertNotEqual(0, hancho_py.app.build_all())
+        self.assertEqual(0, middle._pending_deps)
+        self.assertEqual(0, last._pending_deps)
+        self.assertEqual(middle._state, hancho_py.TaskState.CANCELLED)
+        self.assertEqual(last._state, hancho_py.TaskState.CANCELLED)
+        self.assertEqual(passes._state, hancho_py.TaskState.FINISHED)
+        self.assertFalse(Path("build/last.txt").exists())
+
+    ########################################
+
     def test_job_count(self):
         """We should be able to dispatch tasks that require various numbers of jobs/cores."""
         # Queues up 100 tasks that use random numbers of cores, then a "Job Hog" that uses all cores, then
@@ -594,6 +971,125 @@ class TestHancho(unittest.TestCase):
         self.assertEqual(0, hancho_py.app.build_all())
         self.assertTrue(Path("build/slow_result.txt").exists())
 
+    ########################################
+
+    def test_job_pool_cancel_while_waiting(self):
+        """A task cancelled while waiting for jobs should leave the queue and not block others."""
+        hancho_py.app.parse_flags(["--quiet", "-j4"])
+
+        async def run():
+            pool = hancho_py.JobPool()
+            pool.reset(4)
+            hog, cancelled, waiting = object(), object(), object()
+            await pool.acquire_jobs(4, hog)
+            cancelled_task = asyncio.create_task(pool.acquire_jobs(2, cancelled))
+            waiting_task = asyncio.create_task(pool.acquire_jobs(2, waiting))
+            await asyncio.sleep(0)
+            self.assertEqual(2, len(pool.waiters))
+
+            cancelled_task.cancel()
+            await asyncio.gather(cancelled_task, return_exceptions=True)
+            self.assertEqual(1, len(pool.waiters))
+
+            await pool.release_jobs(4, hog)
+            await asyncio.wait_for(waiting_task, 1)
+            self.assertEqual(2, pool.jobs_free)
+            self.assertEqual(2, pool.job_slots.count(waiting))
+            self.assertEqual(0, pool.job_slots.count(cancelled))
+
+        asyncio.run(run())
+
+    ########################################
+
+    def test_job_pool_cancel_after_wakeup(self):
+        """A task cancelled right after being handed its jobs should give them back, and the tasks
+        queued behind it should get them."""
+        hancho_py.app.parse_flags(["--quiet", "-j4"])
+
+        async def run():
+            pool = hancho_py.JobPool()
+            pool.reset(4)
+            hog, cancelled, big = object(), object(), object()
+            await pool.acquire_jobs(4, hog)
+            cancelled_task = asyncio.create_task(pool.acquire_jobs(2, cancelled))
+            big_task = asyncio.create_task(pool.acquire_jobs(4, big))
+            await asyncio.sleep(0)
+
+            # Releasing hands 2 jobs to cancelled_task, but it gets cancelled before it can run.
+            await pool.release_jobs(4, hog)
+            self.assertEqual(2, pool.jobs_free)
+            cancelled_task.cancel()
+            await asyncio.gather(cancelled_task, return_exceptions=True)
+            self.assertTrue(cancelled_task.cancelled())
+
+            await asyncio.wait_for(big_task, 1)
+            self.assertEqual(0, pool.jobs_free)
+            self.assertEqual(4, pool.job_slots.count(big))
+            self.assertEqual(0, len(pool.waiters))
+
+        asyncio.run(run())
+
+    ########################################
+
+    def test_callback_awaits_subtask(self):
+        """A callback holding a job can await a sub-task it created, even if a bigger task is
+        already waiting for jobs."""
+        os.makedirs("build", exist_ok=True)
+        with open("build/subtask.hancho", "w", encoding="utf-8") as file:
+            file.write("import asyncio\n")
+            file.write("async def callback(task):\n")
+            file.write("    await asyncio.sleep(0.1)\n")
+            file.write("    sub = hancho(command = 'touch {rel(out_txt)}', in_src = [], out_txt = 'sub.txt')\n")
+            file.write("    await sub.await_done()\n")
+            file.write("hancho(command = callback, in_src = [], out_txt = [])\n")
+            file.write("hancho(command = 'touch {rel(out_txt)}', in_src = [], out_txt = 'big.txt', job_count = 2)\n")
+        try:
+            result = subprocess.run(
+                "python3 ../../hancho.py -j2 -f subtask.hancho",
+                shell=True,
+                text=True,
+                capture_output=True,
+                cwd="build",
+                check=False,
+                timeout=10,
+            )
+        except subprocess.TimeoutExpired:
+            self.fail("Build deadlocked")
+        self.assertEqual(0, result.returncode)
+        self.assertTrue(Path("build/build/sub.txt").exists())
+        self.assertTrue(Path("build/build/big.txt").exists())
+
+    ########################################
+
+    def test_callback_awaits_subtask_many_waiters(self):
+        """A callback holding a job can await a sub-task it created, even if more tasks than there
+        are workers are already waiting for jobs."""
+        os.makedirs("build", exist_ok=True)
+        with open("build/subtask_many.hancho", "w", encoding="utf-8") as file:
+            file.write("import asyncio\n")
+            file.write("async def callback(task):\n")
+            file.write("    await asyncio.sleep(0.2)\n")
+            file.write("    sub = hancho(command = 'touch {rel(out_txt)}', in_src = [], out_txt = 'sub.txt')\n")
+            file.write("    await sub.await_done()\n")
+            file.write("hancho(command = callback, in_src = [], out_txt = [])\n")
+            file.write("for i in range(12):\n")
+            file.write("    hancho(command = 'touch {rel(out_txt)}', in_src = [], out_txt = f'big{i}.txt', job_count = 2)\n")
+        try:
+            result = subprocess.run(
+                "python3 ../../hancho.py -j2 -f subtask_many.hancho",
+                shell=True,
+                text=True,
+                capture_output=True,
+                cwd="build",
+                check=False,
+                timeout=10,
+            )
+        except subprocess.TimeoutExpired:
+            self.fail("Build deadlocked")
+        self.assertEqual(0, result.returncode)
+        self.assertTrue(Path("build/build/sub.txt").exists())
+        self.assertTrue(Path("build/build/big11.txt").exists())
+
 ####################################################################################################
 
 import cProfile